@@ -22,114 +22,333 @@ Script to manage Github repositories from Raycast.
 """
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import json
 import os
 from pathlib import Path
+import shutil
+import subprocess
 import sys
+import time
 
 from dotenv import load_dotenv
-from github import Github
 from git import Repo
+import requests
 
-repo_folder = f"{Path.home()}/github/personal/"
-ignored_folders = [
-    ".git",
-    ".DS_Store",
-    ".obsidian",
-]
+REPO_FOLDER = str(Path.home() / "github" / "personal")
+IGNORED_FOLDERS = frozenset(
+    {
+        ".git",
+        ".DS_Store",
+        ".obsidian",
+    }
+)
 USE_GIT_URL = False
+MAX_CLONE_WORKERS = 8
+MAX_STATUS_WORKERS = 16
+MAX_DELETE_WORKERS = 8
+SHALLOW_CLONE_OPTIONS = ["--filter=blob:none", "--no-tags"]
+# Share one ssh connection to github-dg between clones instead of a handshake per repo
+SSH_COMMAND = (
+    "ssh -o ControlMaster=auto -o ControlPath=~/.ssh/cm-%r@%h:%p -o ControlPersist=60s"
+)
+GREEN_DOT = "\033[0;32m●\033[0m"
+YELLOW_DOT = "\033[0;33m●\033[0m"
+GREY_DOT = "\033[0;30;40m●\033[0m"
+RED_DOT = "\033[0;31m●\033[0m"
+GRAPHQL_URL = "https://api.github.com/graphql"
+CACHE_FILE = Path.home() / ".cache" / "repos-script" / "repos.json"
+# A stale cache is always refetched in full: the list comes from a GraphQL POST,
+# and GitHub only answers conditional GET requests with a free 304
+CACHE_TTL = 900  # seconds
+REPOS_QUERY = """
+query($after: String) {
+  viewer {
+    repositories(first: 100, after: $after, ownerAffiliations: [OWNER]) {
+      nodes {
+        name
+        isArchived
+        createdAt
+        updatedAt
+        defaultBranchRef { name }
+        url
+        sshUrl
+        diskUsage
+        watchers { totalCount }
+        visibility
+      }
+      pageInfo { endCursor hasNextPage }
+    }
+  }
+}
+"""
 
 load_dotenv()
-u = os.getenv("GITHUB_USERNAME")
-t = os.getenv("GITHUB_TOKEN")
 
-g = Github(t)
 
+class GitHubAPIError(Exception):
+    """The GitHub API returned errors for a query."""
+
+
+def _client():
+    """Create a GitHub API session, only when a request is actually made."""
+    token = os.getenv("GITHUB_TOKEN")
+    assert token, "Please set GITHUB_TOKEN in .env"
+    session = requests.Session()
+    session.headers["Authorization"] = f"bearer {token}"
+    return session
+
+
+def read_cache():
+    """Read the cached repo list, or None if there is no usable cache."""
+    try:
+        with open(CACHE_FILE, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_cache(data):
+    """Write the repo list to the cache with the time it was fetched."""
+    CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+    with open(CACHE_FILE, "w", encoding="utf-8") as f:
+        json.dump({"fetched_at": time.time(), "data": data}, f)
+
+
+def git_status(path):
+    """Classify a working tree as clean, dirty or untracked with one git call."""
+    result = subprocess.run(
+        ["git", "-C", path, "status", "--porcelain"],
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    if result.returncode != 0:
+        return None
+    lines = result.stdout.splitlines()
+    if any(line.startswith("??") for line in lines):
+        return "untracked"
+    if lines:
+        return "dirty"
+    return "clean"
+
+
+def ssh_command():
+    """Return the multiplexing ssh command, or None if the user has set their own."""
+    if os.getenv("GIT_SSH_COMMAND") or os.getenv("GIT_SSH"):
+        return None
+    # Only user-wide settings apply to clones, not the config of the repo we run from
+    for scope in ("--global", "--system"):
+        result = subprocess.run(
+            ["git", "config", scope, "--get", "core.sshCommand"],
+            capture_output=True,
+            text=True,
+            check=False,
+        )
+        if result.stdout.strip():
+            return None
+    return SSH_COMMAND
+
+
+def clone_repo(url, path, options):
+    """Clone url into path, returning the error instead of raising it."""
+    try:
+        Repo.clone_from(url, path, **options)
+    except Exception as err:  # pylint: disable=broad-except
+        return err
+    return None
+
+
+def report_clone(repo, error, failed):
+    """Print the outcome of a clone, adding the repo to failed if it errored."""
+    print()
+    if error:
+        failed.append(repo)
+        print(f"Failed to clone {repo}: {error}")
+    else:
+        print(f"Cloned {repo}")
 
-class Repos:
+
+def remove(path):
+    """Remove a folder tree, or a single file, without shelling out."""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+class Repos:  # pylint: disable=too-many-instance-attributes
     """Get all repos from git user and check if they are cloned on locally."""
 
-    def __init__(self, include_archived=False, interactive=False):
-        self.repos = g.get_user().get_repos()
+    def __init__(self, include_archived=False, interactive=False, refresh=False):
         self.interactive = interactive
         self.include_archived = include_archived
+        self.repos = self.fetch(refresh)  # Lazy, nothing is requested until get()
         self.active_repos = {}
-        self.missing_repos = self.missing()
+        self.statuses = {}
+        self.present = self.scan()
+        self.missing_repos = []
         self.orphaned_repos = []
         self.orphaned_repos_deleted = 0
 
+    def fetch(self, refresh=False):
+        """Yield the user's repos from the GraphQL API as each page of 100 arrives."""
+        cache = read_cache()
+        if cache and not refresh:
+            if time.time() - cache["fetched_at"] < CACHE_TTL:
+                yield from cache["data"]
+                return
+        repos = []
+        variables = {"after": None}
+        # Each page needs the previous page's cursor, so pages are requested in turn
+        with _client() as session:
+            while True:
+                response = session.post(
+                    GRAPHQL_URL,
+                    json={"query": REPOS_QUERY, "variables": variables},
+                    timeout=30,
+                )
+                response.raise_for_status()
+                payload = response.json()
+                if "errors" in payload:
+                    raise GitHubAPIError(payload["errors"][0]["message"])
+                page = payload["data"]["viewer"]["repositories"]
+                repos.extend(page["nodes"])
+                yield from page["nodes"]
+                if not page["pageInfo"]["hasNextPage"]:
+                    break
+                variables["after"] = page["pageInfo"]["endCursor"]
+        write_cache(repos)
+
     def get(self):
-        """Get repos."""
-        for repo in self.repos:
-            if repo.owner.login == u:
-                self.active_repos[repo.name] = {
-                    "archived": repo.archived,
-                    "created_at": repo.created_at,
-                    "default_branch": repo.default_branch,
-                    "git_url": repo.git_url,
-                    "last_modified": repo.last_modified,
-                    "orphaned": False,
-                    "size": repo.size,
-                    "ssh_url": repo.ssh_url,
-                    "watchers_count": repo.watchers_count,
-                    "visibility": repo.visibility,
-                }
+        """Get repos, probing the status of local clones while later pages download."""
+        with ThreadPoolExecutor(max_workers=MAX_STATUS_WORKERS) as executor:
+            for repo in self.repos:
+                self.add(repo)
+                name = repo["name"]
+                if name in self.present and (
+                    self.include_archived or not repo["isArchived"]
+                ):
+                    path = os.path.join(REPO_FOLDER, name)
+                    if not os.path.exists(os.path.join(path, ".git")):
+                        self.active_repos[name]["orphaned"] = True
+                        continue
+                    self.statuses[name] = executor.submit(git_status, path)
+        self.missing_repos = self.missing()
+        self.orphaned_repos = sorted(
+            self.present - self.active_repos.keys() - IGNORED_FOLDERS
+        )
         return self.active_repos
 
-    def clone(self, missing_repos):
-        """Clone repos."""
+    def add(self, repo):
+        """Add a repo from the API to active_repos."""
+        self.active_repos[repo["name"]] = {
+            "archived": repo["isArchived"],
+            "created_at": repo["createdAt"],
+            "default_branch": (repo["defaultBranchRef"] or {}).get("name"),
+            "git_url": f'{repo["url"].replace("https://", "git://")}.git',
+            "last_modified": repo["updatedAt"],
+            "orphaned": False,
+            "size": repo["diskUsage"],
+            "ssh_url": repo["sshUrl"],
+            "watchers_count": repo["watchers"]["totalCount"],
+            "visibility": repo["visibility"].lower(),
+        }
+
+    def scan(self):
+        """Snapshot the folder names in REPO_FOLDER with a single directory read."""
+        try:
+            with os.scandir(REPO_FOLDER) as entries:
+                return frozenset(entry.name for entry in entries)
+        except FileNotFoundError:
+            return frozenset()
+
+    def clone_urls(self, missing_repos):
+        """Get the clone url of each missing repo that should be cloned."""
+        clones = {}
+        active_repos = self.active_repos
+        present = self.present
+        include_archived = self.include_archived
         for repo in missing_repos:  # pylint: disable=not-an-iterable
-            if not self.include_archived:
-                if self.active_repos[repo]["archived"]:
-                    continue
-            print()
-            print(f"Cloning {repo}...")
+            meta = active_repos[repo]
+            if repo in present or (not include_archived and meta["archived"]):
+                continue
             if USE_GIT_URL:
-                if not os.path.exists(f"{repo_folder}{repo}"):
-                    Repo.clone_from(
-                        f'{self.active_repos[repo]["git_url"]}', f"{repo_folder}{repo}"
-                    )
+                clones[repo] = meta["git_url"]
             else:
-                if not os.path.exists(f"{repo_folder}{repo}"):
-                    Repo.clone_from(
-                        f'{self.active_repos[repo]["ssh_url"].replace("github.com", "github-dg")}',
-                        f"{repo_folder}{repo}",
-                    )  # Use github-dg for ssh_url
+                clones[repo] = meta["ssh_url"].replace(
+                    "github.com", "github-dg"
+                )  # Use github-dg for ssh_url
+        return clones
+
+    def clone(self, missing_repos, shallow=False):
+        """Clone repos, as blobless partial clones if shallow is set."""
+        clones = self.clone_urls(missing_repos)
+        if not clones:
+            return
+        options = {"multi_options": SHALLOW_CLONE_OPTIONS if shallow else None}
+        pending = list(clones.items())
+        failed = []
+        if not USE_GIT_URL:
+            command = ssh_command()
+            if command:
+                options["env"] = {"GIT_SSH_COMMAND": command}
+            # Clone one repo up front so its connection is the master the others reuse
+            repo, url = pending.pop(0)
+            error = clone_repo(url, os.path.join(REPO_FOLDER, repo), options)
+            report_clone(repo, error, failed)
+        if pending:
+            # Each clone blocks on a git subprocess, so threads overlap the network waits
+            with ThreadPoolExecutor(
+                max_workers=min(MAX_CLONE_WORKERS, len(pending))
+            ) as executor:
+                futures = {
+                    executor.submit(
+                        clone_repo, url, os.path.join(REPO_FOLDER, repo), options
+                    ): repo
+                    for repo, url in pending
+                }
+                for future in as_completed(futures):
+                    report_clone(futures[future], future.result(), failed)
+        self.present = self.scan()
+        if failed:
+            print()
+            print(f"Failed to clone {len(failed)} repos:")
+            sys.stdout.write("".join(f"{RED_DOT} {repo}\n" for repo in sorted(failed)))
 
     def missing(self):
         """Get missing repos."""
-        missing_repos = []
-        for repo in self.active_repos:  # pylint: disable=consider-using-dict-items
-            if not self.include_archived:
-                if self.active_repos[repo]["archived"]:
-                    continue
-            if not os.path.exists(f"{repo_folder}{repo}"):
-                missing_repos.append(repo)
-            if self.active_repos[repo]["orphaned"]:
-                if os.path.exists(f"{repo_folder}{repo}"):
-                    missing_repos.append(repo)
-        return missing_repos
+        present = self.present
+        include_archived = self.include_archived
+        return [
+            repo
+            for repo, meta in self.active_repos.items()
+            if (include_archived or not meta["archived"]) and repo not in present
+        ]
 
     def delete(self, ignore_prompt=False):  # pylint: disable=too-many-branches
         """Delete repos."""
-        for repo in os.listdir(repo_folder):
-            if repo not in ignored_folders:
-                if repo not in self.active_repos:
+        if not self.include_archived:
+            present = self.present
+            for repo, meta in self.active_repos.items():
+                if meta["archived"] and repo in present:
                     self.orphaned_repos.append(repo)
-        for repo in self.active_repos:  # pylint: disable=consider-using-dict-items
-            if not self.include_archived:
-                if self.active_repos[repo]["archived"]:
-                    if os.path.exists(f"{repo_folder}{repo}"):
-                        self.orphaned_repos.append(repo)
         if self.orphaned_repos:
-            for repo in self.orphaned_repos:  # pylint: disable=not-an-iterable
-                if ignore_prompt or not self.interactive:
-                    # Raycast does not support input, so we will delete the orphaned repos without confirmation
-                    os.system(f"rm -rf {repo_folder}{repo}")
-                    self.orphaned_repos_deleted += 1
-                else:
+            if ignore_prompt or not self.interactive:
+                # Raycast does not support input, so we will delete the orphaned repos without confirmation
+                paths = [
+                    os.path.join(REPO_FOLDER, repo) for repo in self.orphaned_repos
+                ]
+                with ThreadPoolExecutor(
+                    max_workers=min(MAX_DELETE_WORKERS, len(paths))
+                ) as executor:
+                    list(executor.map(remove, paths))
+                self.orphaned_repos_deleted += len(paths)
+            else:
+                for repo in self.orphaned_repos:  # pylint: disable=not-an-iterable
                     choice = input(f"Press 'y' to delete {repo}...")
                     if choice.lower() == "y":
-                        os.system(f"rm -rf {repo_folder}{repo}")
+                        remove(os.path.join(REPO_FOLDER, repo))
                         self.orphaned_repos_deleted += 1
 
             print(f"Deleted {self.orphaned_repos_deleted} orphaned repos.")
@@ -139,24 +358,27 @@ class Repos:
 
     def print(self, repos):
         """Print repos."""
+        lines = []
         for repo in repos:
-            if os.path.exists(f"{repo_folder}{repo}"):
-                try:
-                    current_repo = Repo(f"{repo_folder}{repo}")
-                except:  # pylint: disable=bare-except
-                    self.active_repos[repo]["orphaned"] = True
-                if current_repo.untracked_files:
-                    print(f"\033[0;33m●\033[0m {repo} (untracked files)")
-                elif current_repo.is_dirty():
-                    print(f"\033[0;33m●\033[0m {repo} (dirty)")
-                elif self.active_repos[repo]["orphaned"]:
-                    print(f"\033[0;33m●\033[0m {repo} (orphaned)")
-                elif self.active_repos[repo]["archived"]:
-                    print(f"\033[0;30;40m●\033[0m {repo} (archived)")
+            meta = self.active_repos[repo]
+            if repo in self.present:
+                future = self.statuses.get(repo)
+                status = future.result() if future else None
+                if status is None:
+                    meta["orphaned"] = True
+                if status == "untracked":
+                    lines.append(f"{YELLOW_DOT} {repo} (untracked files)")
+                elif status == "dirty":
+                    lines.append(f"{YELLOW_DOT} {repo} (dirty)")
+                elif meta["orphaned"]:
+                    lines.append(f"{YELLOW_DOT} {repo} (orphaned)")
+                elif meta["archived"]:
+                    lines.append(f"{GREY_DOT} {repo} (archived)")
                 else:
-                    print(f"\033[0;32m●\033[0m {repo}")
+                    lines.append(f"{GREEN_DOT} {repo}")
             else:
-                print(f"\033[0;30;40m●\033[0m {repo} (archived not cloned)")
+                lines.append(f"{GREY_DOT} {repo} (archived not cloned)")
+        sys.stdout.write("\n".join(lines) + "\n")
 
 
 def parse_args(args=None, unknown=None):
@@ -174,6 +396,15 @@ def parse_args(args=None, unknown=None):
     parser.add_argument(
         "-m", "--missing", help="List missing repos", action="store_true"
     )
+    parser.add_argument(
+        "-r", "--refresh", help="Ignore the cached repo list", action="store_true"
+    )
+    parser.add_argument(
+        "-s",
+        "--shallow",
+        help="Clone without file contents of past commits (blobless partial clone)",
+        action="store_true",
+    )
     parser.add_argument(
         "-y",
         "--yes",
@@ -201,26 +432,20 @@ def main():  # pylint: disable=too-many-branches
     if sys.stdin and sys.stdin.isatty():
         interactive = True
 
-    repositories = Repos(include_archived, interactive)
-    all_repos = repositories.get()
-    missing_repos = repositories.missing()
+    # Deleting from a stale list could remove a freshly created repo's clone
+    refresh = args.refresh or args.delete
+    repositories = Repos(include_archived, interactive, refresh)
+    try:
+        all_repos = repositories.get()
+    except GitHubAPIError as err:
+        sys.exit(f"GitHub API error: {err}")
+    missing_repos = repositories.missing_repos
 
     if all_repos:
-        for repo in all_repos:  # pylint: disable=consider-using-dict-items
-            if repo in ignored_folders:
+        for name, meta in all_repos.items():
+            if name in IGNORED_FOLDERS or (not include_archived and meta["archived"]):
                 continue
-            if all_repos[repo]["visibility"] == "public":
-                if not include_archived:
-                    if not all_repos[repo]["archived"]:
-                        public.append(repo)
-                else:
-                    public.append(repo)
-            else:
-                if not include_archived:
-                    if not all_repos[repo]["archived"]:
-                        private.append(repo)
-                else:
-                    private.append(repo)
+            (public if meta["visibility"] == "public" else private).append(name)
         if public:
             print(f"Public repos ({len(public)}):")
             repositories.print(public)
@@ -230,8 +455,7 @@ def main():  # pylint: disable=too-many-branches
             repositories.print(private)
         if args.clone:
             if missing_repos:
-                for repo in missing_repos:
-                    repositories.clone(missing_repos)
+                repositories.clone(missing_repos, args.shallow)
             else:
                 print()
                 print("No missing repos to clone.")
@@ -239,11 +463,23 @@ def main():  # pylint: disable=too-many-branches
             if missing_repos:
                 print()
                 print("Missing repos:")
-                for repo in missing_repos:
-                    print(f"\033[0;31m●\033[0m {repo}")
+                sys.stdout.write(
+                    "".join(f"{RED_DOT} {repo}\n" for repo in missing_repos)
+                )
             else:
                 print()
                 print("No missing repos.")
+            not_git = [repo for repo, meta in all_repos.items() if meta["orphaned"]]
+            if not_git:
+                # clone() skips these, so list them apart from the missing repos
+                print()
+                print("Not git repos:")
+                sys.stdout.write(
+                    "".join(
+                        f"{YELLOW_DOT} {repo} (exists but is not a git repo)\n"
+                        for repo in not_git
+                    )
+                )
         if args.delete:
             repositories.delete(args.yes)
     else:
@@ -251,6 +487,4 @@ def main():  # pylint: disable=too-many-branches
 
 
 if __name__ == "__main__":
-    assert u, "Please set GITHUB_USERNAME in .env"
-    assert t, "Please set GITHUB_TOKEN in .env"
     main()